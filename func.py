@@ -5,12 +5,17 @@
 # Licensed under the Universal Permissive License v 1.0 as shown at https://oss.oracle.com/licenses/upl.
 
 import io
-import json
+import itertools
 import logging
 import os
 import re
+import orjson
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+from typing import Any, Callable
+from urllib3.util.retry import Retry
 
 """
     This sample OCI Function maps OCI Monitoring Service Raw Metrics to the MoogSoft 
@@ -22,23 +27,45 @@ from datetime import datetime
 
 api_endpoint = os.getenv('API_ENDPOINT', 'not-configured')
 api_key = os.getenv('API_KEY', 'not-configured')
-is_forwarding = eval(os.getenv('FORWARDING_ENABLED', "False"))
-batch_size = int(os.getenv('BATCH_SIZE', '500'))
+is_forwarding = os.getenv('FORWARDING_ENABLED', 'False').strip().lower() in ('1', 'true', 'yes')
+batch_size = max(1, int(os.getenv('BATCH_SIZE', '500')))
+max_concurrent_posts = max(1, int(os.getenv('MAX_CONCURRENT_POSTS', '16')))
+
+# Metric payload keys that are to be converted to a tag (de-duplicated, in configured order)
 
 tag_keys = os.getenv('TAG_KEYS', 'name, namespace, displayName, resourceDisplayName, unit')
-tag_set = set()
+_TAG_KEYS = tuple(dict.fromkeys(x.strip() for x in tag_keys.split(',') if x.strip()))
 
-# Set all registered loggers to the configured log_level
+# Set the root logger to the configured log_level (child loggers inherit it)
 
 logging_level = os.getenv('LOGGING_LEVEL', 'INFO')
-loggers = [logging.getLogger()] + [logging.getLogger(name) for name in logging.root.manager.loggerDict]
-[logger.setLevel(logging.getLevelName(logging_level)) for logger in loggers]
+logging.getLogger().setLevel(logging.getLevelName(logging_level))
 
 # Constants
 
 TEN_MINUTES_SEC = 10 * 60
 ONE_HOUR_SEC = 60 * 60
 
+# Splits camel case metric names (e.g. VnicFromNetworkMirrorBytes) into words
+
+_CAMEL_RE = re.compile(r'[A-Z](?:[a-z]+|[A-Z]*(?=[A-Z]|$))')
+
+# Function containers are reused between invocations, so a module-level session keeps
+# the connection pool (and its TCP + TLS connections) to MoogSoft warm across calls.
+
+HTTP_TIMEOUT_SEC = 10
+
+_SESSION = requests.Session()
+_SESSION.headers.update({'Content-Type': 'application/json', 'apiKey': api_key})
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=max_concurrent_posts,
+    max_retries=Retry(total=3,
+                      backoff_factor=0.2,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=frozenset(['POST']),
+                      raise_on_status=False)))
+
 """
 """
 
@@ -51,14 +78,22 @@ def handler(ctx, data: io.BytesIO = None):
     :return: plain text response indicating success or error
     """
 
-    preamble = " {} / event count = {} / logging level = {} / forwarding to MoogSoft = {}"
-
     try:
-        metrics_list = json.loads(data.getvalue())
-        logging.info(preamble.format(ctx.FnName(), len(metrics_list), logging_level, is_forwarding))
+        # parse straight from the BytesIO buffer rather than copying it out with getvalue()
+
+        with data.getbuffer() as buffer:
+            metrics_list = orjson.loads(buffer)
+
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info(f' {ctx.FnName()} / event count = {len(metrics_list)} / logging level = {logging_level}'
+                         f' / forwarding to MoogSoft = {is_forwarding}')
 
         # logging.debug(metrics_list)
 
+        if is_forwarding is False and not logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.info("MoogSoft forwarding is disabled - nothing sent")
+            return
+
         transformed_event_list = transform_metric_events(event_list=metrics_list)
         send_to_moogsoft_endpoint(event_list=transformed_event_list)
 
@@ -69,20 +104,24 @@ def handler(ctx, data: io.BytesIO = None):
 
 def transform_metric_events(event_list):
     """
+    Lazily transforms the metric records so batches can be sent while later records are still being transformed.
     :param event_list: the list of metric formatted log records.
-    :return: the list of MoogSoft formatted log records
+    :return: generator of MoogSoft formatted log records
     """
 
-    result_list = []
+    transform = _make_transform(_TAG_KEYS)
+    is_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+
     for event in event_list:
-        single_result = transform_metric_to_moogsoft_format(log_record=event)
-        result_list.extend(single_result)
-        logging.debug(single_result)
+        records = transform(event)
+        if is_debug:
+            for record in records:
+                logging.debug(record)
 
-    return result_list
+        yield from records
 
 
-def transform_metric_to_moogsoft_format(log_record: dict):
+def transform_metric_to_moogsoft_format(log_record: dict) -> list[dict]:
     """
     Transform metrics to MoogSoft format.
     MoogSoft is expecting Unix time ... see https://en.wikipedia.org/wiki/Unix_time
@@ -90,176 +129,171 @@ def transform_metric_to_moogsoft_format(log_record: dict):
     :return: MoogSoft formatted log record
     """
 
-    payload = []
-    data_points = get_data_points(log_record)
-    for dp in data_points:
-        transformed_record = {
-                'metric': get_dictionary_value(log_record, 'displayName'),
-                'source': get_source(log_record),
-                'time': dp.get('timestamp'),
-                'data': dp.get('value'),
-                'tags': get_tags(log_record),
+    return _make_transform(_TAG_KEYS)(log_record)
+
+
+def _make_transform(tag_keys: tuple[str, ...]) -> Callable[[dict], list[dict]]:
+    """
+    Builds the metric transform specialized for a batch, binding the tag keys and helper
+    functions once so the per-record path reads closure locals rather than module globals.
+    :param tag_keys: the metric payload keys that are to be converted to a tag
+    :return: function mapping a metric log record to a list of MoogSoft formatted records
+    """
+
+    source_of = get_source
+    tags_of = get_tags
+
+    def transform(log_record: dict) -> list[dict]:
+
+        # these are constant across the record's datapoints so look them up once.
+        # OCI metric records carry these at fixed locations so no recursive scan is needed.
+
+        display_name = (log_record.get('metadata') or {}).get('displayName')
+        source = source_of(log_record)
+        tags = tags_of(log_record, tag_keys)
+
+        return [
+            {
+                'metric': display_name,
+                'source': source,
+                'time': dp['timestamp'],
+                'data': dp['value'],
+                'tags': tags,
             }
-        payload.append(transformed_record)
+            for dp in log_record.get('datapoints') or ()
+        ]
 
-    return payload
+    return transform
 
 
-def get_source(log_record: dict):
+def get_source(log_record: dict) -> str:
     """
     Assembles a metric name that is compatible with MoogSoft.
     :param log_record:
     :return:
     """
 
-    elements = get_dictionary_value(log_record, 'namespace').split('_')
-    elements += camel_case_split(get_dictionary_value(log_record, 'name'))
-    elements = [element.lower() for element in elements]
-    return '.'.join(elements)
+    source = log_record.get('namespace', '').replace('_', '.')
+    words = camel_case_split(log_record.get('name', ''))
+    if words:
+        source += '.' + '.'.join(words)
+
+    return source.lower()
 
 
-def camel_case_split(string):
+def camel_case_split(string: str) -> list[str]:
     """
     :param string:
     :return: Splits camel case string to individual strings
     """
 
-    return re.findall(r'[A-Z](?:[a-z]+|[A-Z]*(?=[A-Z]|$))', string)
+    return _CAMEL_RE.findall(string)
 
 
 def get_now_timestamp():
     return datetime.now().timestamp()
 
 
-def get_data_points(log_record: dict):
-    """
-    :param log_record:
-    :return: an array of arrays where each array is a datapoint scalar pair
-    """
-
-    result = []
-
-    datapoints = get_dictionary_value(dictionary=log_record, target_key='datapoints')
-    for point in datapoints:
-        data_point = {'timestamp': point.get('timestamp'), 'value': point.get('value')}
-
-        result.append(data_point)
-
-    return result
-
-
-def get_tags(log_record: dict):
+def get_tags(log_record: dict, tag_keys: tuple[str, ...] = _TAG_KEYS) -> list[str]:
     """
     Assembles tags from selected metric attributes.
     See https://docs.MoogSofthq.com/getting_started/tagging/
     :param log_record: the log record to scan
+    :param tag_keys: the metric payload keys that are to be converted to a tag
     :return: string of comma-separated, key:value pairs matching MoogSoft tag format
     """
 
-    result = []
-
-    for tag in get_tag_set():
-        value = get_dictionary_value(dictionary=log_record, target_key=tag)
-        if value is None:
-            continue
-
-        if isinstance(value, str) and ':' in value:
-            logging.warning('tag contains a \':\' / ignoring {} ({})'.format(tag, value))
-            continue
+    return [
+        f'{tag}:{value}'
+        for tag in tag_keys
+        if (value := get_dictionary_value(log_record, tag)) is not None
+        and not (isinstance(value, str) and ':' in value and _ignore_tag(tag, value))
+    ]
 
-        tag = '{}:{}'.format(tag, value)
-        result.append(tag)
 
-    return result
-
-
-def get_tag_set():
+def _ignore_tag(tag: str, value: str) -> bool:
     """
-    :return: the set metric payload keys that are to be converted to a tag.
+    Warns that a tag is being dropped; only reached for the rare value containing a ':'.
+    :param tag: the tag key
+    :param value: the offending tag value
+    :return: True, so the caller's filter excludes the tag
     """
 
-    global tag_set
-
-    if len(tag_set) == 0 and tag_keys:
-        split_and_stripped_tags = [x.strip() for x in tag_keys.split(',')]
-        tag_set.update(split_and_stripped_tags)
-        logging.debug("tag key set / {} ".format(tag_set))
-
-    return tag_set
+    logging.warning('tag contains a \':\' / ignoring {} ({})'.format(tag, value))
+    return True
 
 
 def send_to_moogsoft_endpoint(event_list):
     """
     Sends each transformed event to API Endpoint.
-    :param event_list: list of events in Moogsoft format
+    :param event_list: list (or iterable) of events in Moogsoft format
     :return: None
     """
 
     if is_forwarding is False:
         logging.info("MoogSoft forwarding is disabled - nothing sent")
-        logging.info(json.dumps(event_list, indent=2))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(orjson.dumps(list(event_list), option=orjson.OPT_INDENT_2).decode())
         return
 
-    # creating a session and adapter to avoid recreating
-    # a new connection pool between each POST call
-
-    try:
+    # send payload in batches, posting each batch over the shared session as soon as it fills
 
-        session = requests.Session()
-        adapter = requests.adapters.HTTPAdapter(pool_connections=10, pool_maxsize=10)
-        session.mount('https://', adapter)
+    batches = (orjson.dumps(batch_list) for batch_list in _batched(event_list, batch_size))
 
-        http_headers = {'Content-Type': 'application/json', 'apiKey': api_key}
-        logging.debug("headers to MoogSoft: {}".format(http_headers))
+    def post_batch(batch_body: bytes):
+        response = _SESSION.post(api_endpoint, data=batch_body, timeout=HTTP_TIMEOUT_SEC)
+        if response.status_code not in (200, 201, 202):
+            raise Exception(f'error {response.status_code} sending to MoogSoft: {response.reason}')
 
-        # send payload in batches
+    with ThreadPoolExecutor(max_workers=max_concurrent_posts) as executor:
+        list(executor.map(post_batch, batches))
 
-        batches = []
-        sub_list = []
-        batches.append(sub_list)
 
-        for event in event_list:
-            sub_list.append(event)
-            if len(sub_list) >= batch_size:
-                sub_list = []
-                batches.append(sub_list)
+def _batched(events, size: int):
+    """
+    :param events: list or iterable of events
+    :param size: maximum number of events per batch
+    :return: generator of sequences holding up to size events each
+    """
 
-        for batch_list in batches:
-            response = session.post(api_endpoint, data=json.dumps(batch_list), headers=http_headers)
-            if response.status_code not in (200, 201, 202):
-                raise Exception(f'error {response.status_code} sending to MoogSoft: {response.reason}')
+    if hasattr(itertools, 'batched'):
+        # Python 3.12+; the resulting tuples serialize to JSON arrays just like lists
+        yield from itertools.batched(events, size)
+        return
 
-    finally:
-        session.close()
+    iterator = iter(events)
+    while batch_list := list(itertools.islice(iterator, size)):
+        yield batch_list
 
 
-def get_dictionary_value(dictionary: dict, target_key: str):
+def get_dictionary_value(dictionary: dict, target_key: str) -> Any:
     """
-    Recursive method to find value within a dictionary which may also have nested lists / dictionaries.
+    Depth-first search (using an explicit stack rather than recursion) to find value within a dictionary
+    which may also have nested lists / dictionaries.
     :param dictionary: the dictionary to scan
     :param target_key: the key we are looking for
     :return: If a target_key exists multiple times in the dictionary, the first one found will be returned.
     """
 
     if dictionary is None:
-        raise Exception('dictionary None for key'.format(target_key))
+        raise Exception('dictionary None for key {}'.format(target_key))
+
+    stack: list[dict] = [dictionary]
+    while stack:
+        current = stack.pop()
+        if target_key in current:
+            return current[target_key]
 
-    target_value = dictionary.get(target_key)
-    if target_value:
-        return target_value
+        # push nested dictionaries in reverse so they are popped (visited) in document order
 
-    for key, value in dictionary.items():
-        if isinstance(value, dict):
-            target_value = get_dictionary_value(dictionary=value, target_key=target_key)
-            if target_value:
-                return target_value
+        children: list[dict] = []
+        for value in current.values():
+            if isinstance(value, dict):
+                children.append(value)
+            elif isinstance(value, list):
+                children.extend(entry for entry in value if isinstance(entry, dict))
 
-        elif isinstance(value, list):
-            for entry in value:
-                if isinstance(entry, dict):
-                    target_value = get_dictionary_value(dictionary=entry, target_key=target_key)
-                    if target_value:
-                        return target_value
+        stack.extend(reversed(children))
 
 
 def local_test_mode(filename):
@@ -275,11 +309,11 @@ def local_test_mode(filename):
         transformed_results = list()
 
         for line in f:
-            event = json.loads(line)
-            logging.debug(json.dumps(event, indent=4))
+            event = orjson.loads(line)
+            logging.debug(orjson.dumps(event, option=orjson.OPT_INDENT_2).decode())
             transformed_results += transform_metric_to_moogsoft_format(event)
 
-        logging.debug(json.dumps(transformed_results, indent=4))
+        logging.debug(orjson.dumps(transformed_results, option=orjson.OPT_INDENT_2).decode())
         send_to_moogsoft_endpoint(event_list=transformed_results)
 
     logging.info("local testing completed")